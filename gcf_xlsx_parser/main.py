@@ -1,25 +1,70 @@
 import os
-import json
+import atexit
 import logging
+import logging.handlers
+import queue
+import orjson
+from concurrent.futures import ProcessPoolExecutor
 import requests
-import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from openpyxl import load_workbook
+from python_calamine import CalamineWorkbook
 from flask import Flask, request, jsonify
+from google.api_core.exceptions import NotFound, PreconditionFailed
 from google.cloud import storage
 import functions_framework
 from io import BytesIO
+from datetime import date, datetime, time
+from itertools import chain, islice
+from uuid import uuid4
 
 # Cloud Run Unstructured Parser URL
 CLOUD_RUN_URL = "https://unstructured-parser-258481069493.us-central1.run.app/parse"
 
 app = Flask(__name__)
 
-# Configure logging
+# Shared session so warm instances keep the connection to Cloud Run alive between requests.
+# The POST is only retried when Cloud Run cannot have processed it: failed connects and
+# 502/503 responses. Read errors and 504s may mean the file is already being parsed.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=3, connect=3, read=0, backoff_factor=0.2, status_forcelist=(502, 503),
+                      allowed_methods=frozenset({"POST"}), raise_on_status=False),
+))
+
+# Configure logging: records are queued on the request thread and written to stderr (picked up by
+# Cloud Logging) from a background listener, so no request blocks on log I/O
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+_queue_handler = logging.handlers.QueueHandler(_log_queue)
+# Only merge the message here; timestamps and levels are added by the listener's handler
+_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+
 logging.basicConfig(
-    filename="main_parser.log",
-    level=logging.DEBUG,
-    format="%(asctime)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+    handlers=[_queue_handler],
 )
 
+# Number of leading rows per sheet scanned for empty cells during complexity detection
+COMPLEXITY_SCAN_ROWS = 50
+
+# Lowercased sheet names that indicate a structured (non-tabular) layout
+_COMPLEX_SHEETS = frozenset({"overview", "metadata schema", "report"})
+
+# Chunk size for the resumable JSON upload; output is flushed to GCS in pieces of this size
+JSON_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Workbooks at least this large (in bytes) with several sheets are parsed one sheet per process
+PARALLEL_PARSE_MIN_BYTES = 1024 * 1024
+
 # Google Cloud Storage client
 storage_client = storage.Client()
 
@@ -31,31 +76,167 @@ class GCPXLSXParser:
         self.error_blob = error_blob
 
     def json_serializer(self, obj):
-        if isinstance(obj, pd.Timestamp):
-            return obj.strftime("%Y-%m-%d")
-        if pd.isna(obj):
-            return None
+        """Fallback for cell values orjson cannot encode natively, such as timedelta durations.
+
+        Cells arrive as native Python values, so None, NaN and datetimes never reach this hook.
+        """
         return str(obj)
 
-    def detect_complexity(self, xls):
-        """Checks if Excel contains complex structures (merged cells, structured tables, images)."""
-        for sheet_name in xls.sheet_names:
-            df = xls.parse(sheet_name, dtype=str, header=None)
-            if df.isna().sum().sum() > 0:
+    @staticmethod
+    def open_workbook(excel_file, file_format: str):
+        """Opens the workbook from a file-like object; .xlsx via openpyxl read-only, .xls via calamine."""
+        if file_format == "xls":
+            try:
+                return CalamineWorkbook.from_filelike(excel_file)
+            except Exception as e:
+                raise ValueError(f"Invalid .xls file format: {str(e)}")
+        try:
+            # Cached formula values only; skip external link caches, rich-text runs and VBA parts
+            return load_workbook(excel_file, read_only=True, data_only=True,
+                                 keep_links=False, rich_text=False, keep_vba=False)
+        except Exception as e:
+            raise ValueError(f"Invalid .xlsx file format: {str(e)}")
+
+    @staticmethod
+    def calamine_value(cell):
+        """Maps a calamine cell to the value openpyxl would read from the same cell in an .xlsx."""
+        # Calamine reports empty cells as "", every number as a float and date-only cells as dates
+        if cell == "":
+            return None
+        if type(cell) is float:
+            # orjson only encodes 64-bit integers, so larger whole numbers stay floats
+            if cell.is_integer() and -2**63 <= cell < 2**64:
+                return int(cell)
+            return cell
+        if type(cell) is date:
+            return datetime.combine(cell, time())
+        return cell
+
+    @staticmethod
+    def iter_calamine_rows(workbook, sheet_name: str):
+        """Yields the rows of a calamine sheet, which is only loaded once iteration starts."""
+        calamine_value = GCPXLSXParser.calamine_value
+        for row in workbook.get_sheet_by_name(sheet_name).iter_rows():
+            yield tuple(calamine_value(cell) for cell in row)
+
+    @staticmethod
+    def iter_sheets(workbook):
+        """Yields (sheet_name, rows) pairs; rows are tuples of cell values with empty cells as None."""
+        if isinstance(workbook, CalamineWorkbook):
+            for sheet_name in workbook.sheet_names:
+                yield sheet_name, GCPXLSXParser.iter_calamine_rows(workbook, sheet_name)
+        else:
+            for ws in workbook.worksheets:
+                # Dimension records can be stale; without this, read-only rows are cut to them
+                ws.reset_dimensions()
+                yield ws.title, ws.iter_rows(values_only=True)
+
+    @staticmethod
+    def peek_rows(rows):
+        """Reads a sheet's leading rows; returns them with a flag telling whether they are the whole sheet."""
+        leading_rows = list(islice(rows, COMPLEXITY_SCAN_ROWS))
+        return leading_rows, len(leading_rows) < COMPLEXITY_SCAN_ROWS
+
+    @staticmethod
+    def has_data_rows(rows) -> bool:
+        """Checks whether the rows hold anything beyond a header row."""
+        non_empty_rows = (row for row in rows if any(cell is not None for cell in row))
+        return next(non_empty_rows, None) is not None and next(non_empty_rows, None) is not None
+
+    @staticmethod
+    def build_records(rows) -> list:
+        """Builds one dict per non-empty row, keyed by the header row, omitting columns that are empty in every row."""
+        rows = iter(rows)
+        first_row = next(rows, None)
+        if first_row is None:
+            return []
+        # Rows are ragged once dimensions are reset, so the sheet is as wide as its widest row
+        width = len(first_row)
+
+        # Column indices with no value seen so far; usually emptied by the first data row
+        empty_columns = set(range(width))
+        kept_rows = []
+        for row in rows:
+            if not any(cell is not None for cell in row):
+                continue
+            if len(row) > width:
+                empty_columns.update(range(width, len(row)))
+                width = len(row)
+            if empty_columns:
+                empty_columns = {i for i in empty_columns if i >= len(row) or row[i] is None}
+            kept_rows.append(row)
+
+        header = GCPXLSXParser.dedupe_header(
+            [f"Unnamed: {i}" if name is None else str(name)
+             for i, name in enumerate(tuple(first_row) + (None,) * (width - len(first_row)))])
+        keep = [(i, name) for i, name in enumerate(header) if i not in empty_columns]
+        project = GCPXLSXParser.compile_projection(keep)
+        return [project(row if len(row) == width else tuple(row) + (None,) * (width - len(row)))
+                for row in kept_rows]
+
+    @staticmethod
+    def dedupe_header(header) -> list:
+        """Renames repeated header names to 'A', 'A.1', 'A.2', ... the way pandas does, so no column is lost."""
+        names = list(header)
+        taken = set(header)
+        counts = {}
+        for i, name in enumerate(header):
+            count = counts.get(name, 0)
+            if count:
+                # Like pandas, skip suffixes that would clash with a name elsewhere in the header
+                while f"{name}.{count}" in taken:
+                    count += 1
+                names[i] = f"{name}.{count}"
+                taken.add(names[i])
+            counts[name] = count + 1
+        return names
+
+    @staticmethod
+    def compile_projection(keep):
+        """Generates a function mapping a row tuple to its record dict for the given (index, name) columns.
+
+        Keys and indices are inlined as constants, so each row costs a single dict display instead of
+        a comprehension. Names are always str and embedded through repr(), so no header text is executed.
+        """
+        source = "def project(row): return {" + ", ".join(f"{name!r}: row[{i}]" for i, name in keep) + "}"
+        namespace = {}
+        exec(source, namespace)
+        return namespace["project"]
+
+    def is_complex_sheet(self, sheet_name: str, rows) -> bool:
+        """Checks if a sheet contains complex structures (merged cells, structured tables, images).
+
+        The sheet name is checked before any rows are read, and the row scan stops at the first empty cell.
+        """
+        if sheet_name.lower() in _COMPLEX_SHEETS:
+            logging.info(f"Complexity detected in sheet '{sheet_name}': Possible structured format.")
+            return True
+        width = None
+        for row in islice(rows, COMPLEXITY_SCAN_ROWS):
+            # A row shorter or longer than the first has missing cells, just like an explicit None
+            if None in row or (width is not None and len(row) != width):
                 logging.info(f"Complexity detected in sheet '{sheet_name}': Merged/empty cells.")
                 return True
-            if sheet_name.lower() in ["overview", "metadata schema", "report"]:
-                logging.info(f"Complexity detected in sheet '{sheet_name}': Possible structured format.")
-                return True
+            width = len(row)
         return False
 
     def log_error(self, message):
-        """Logs errors to a separate GCS file."""
+        """Logs errors to a separate GCS file, appending to it via object composition."""
         error_blob = self.bucket.blob(self.error_blob)
-        existing_log = ""
-        if error_blob.exists():
-            existing_log = error_blob.download_as_text()
-        error_blob.upload_from_string(existing_log + message + '\n', content_type='text/plain')
+        line = (message + '\n').encode("utf-8")
+        try:
+            # First error for this file: create the log, unless one already exists
+            error_blob.upload_from_file(BytesIO(line), content_type='text/plain', size=len(line),
+                                        if_generation_match=0)
+        except PreconditionFailed:
+            # Upload only the new line and let GCS concatenate it onto the existing log
+            part_blob = self.bucket.blob(f"{self.error_blob}.part-{uuid4().hex}")
+            part_blob.upload_from_file(BytesIO(line), content_type='text/plain', size=len(line))
+            try:
+                error_blob.content_type = 'text/plain'
+                error_blob.compose([error_blob, part_blob])
+            finally:
+                part_blob.delete()
         logging.error(message)
 
     def forward_to_cloud_run(self):
@@ -68,7 +249,8 @@ class GCPXLSXParser:
         }
 
         try:
-            response = requests.post(CLOUD_RUN_URL, json=payload, timeout=300)
+            response = _SESSION.post(CLOUD_RUN_URL, data=orjson.dumps(payload),
+                                     headers={"Content-Type": "application/json"}, timeout=300)
             response_data = response.json()
 
             if response.status_code == 200:
@@ -88,60 +270,102 @@ class GCPXLSXParser:
         """Parses the XLSX/XLS file, handles errors, and switches to Cloud Run when needed."""
         try:
             blob = self.bucket.blob(self.source_blob)
-            if not blob.exists():
+            # Download straight into the buffer the workbook is read from, avoiding a second copy
+            excel_file = BytesIO()
+            try:
+                blob.download_to_file(excel_file)
+            except NotFound:
                 raise ValueError(f"File {self.source_blob} does not exist in bucket.")
-
-            excel_data = blob.download_as_bytes()
-            if not excel_data:
+            file_size = excel_file.tell()
+            if not file_size:
                 raise ValueError("Downloaded file is empty.")
+            excel_file.seek(0)
 
             file_format = "xls" if self.source_blob.endswith(".xls") else "xlsx"
+            workbook = self.open_workbook(excel_file, file_format)
+            sheets = list(self.iter_sheets(workbook))
+            pool = None
+            try:
+                futures = {}
+                peeks = {}
+                check_complexity = True
+                if file_size >= PARALLEL_PARSE_MIN_BYTES and len(sheets) > 1 and (os.cpu_count() or 1) > 1:
+                    # Large multi-sheet workbooks are parsed in parallel, each worker re-opening the workbook
+                    # for its own sheet. Every sheet is peeked first, so a complex workbook is forwarded to
+                    # Cloud Run before any worker starts.
+                    peeks = {index: self.peek_rows(rows) for index, (_, rows) in enumerate(sheets)}
+                    if any(self.is_complex_sheet(sheet_name, peeks[index][0])
+                           for index, (sheet_name, _) in enumerate(sheets)
+                           if not peeks[index][1] or self.has_data_rows(peeks[index][0])):
+                        cloud_run_response = self.forward_to_cloud_run()
+                        if "error" not in cloud_run_response:
+                            return cloud_run_response  # Cloud Run succeeded
+                        logging.warning("Cloud Run processing failed, falling back to normal parsing.")
+                    check_complexity = False
+
+                    # Sheets already read to their end while peeking are finished here
+                    remote = [index for index, (_, fully_read) in peeks.items() if not fully_read]
+                    if remote:
+                        pool = ProcessPoolExecutor(max_workers=min(len(remote), os.cpu_count()))
+                        excel_data = excel_file.getvalue()
+                        futures = {index: pool.submit(build_sheet_records, excel_data, file_format, index)
+                                   for index in remote}
+
+                json_blob = self.bucket.blob(self.destination_blob)
+                # Sheets are serialized one at a time straight into the upload; leaving the
+                # block with an exception (or via terminate()) discards the partial object
+                with json_blob.open("wb", chunk_size=JSON_UPLOAD_CHUNK_SIZE, content_type="application/json") as fh:
+                    fh.write(b"{")
+                    sheets_written = 0
+                    for index, (sheet_name, rows) in enumerate(sheets):
+                        try:
+                            # Only a sheet read to its end within the peeked rows is known to be empty
+                            leading_rows, fully_read = peeks.pop(index) if index in peeks else self.peek_rows(rows)
+                            if fully_read and not self.has_data_rows(leading_rows):
+                                logging.warning(f"Sheet '{sheet_name}' is empty. Skipping.")
+                                continue
+
+                            if check_complexity and self.is_complex_sheet(sheet_name, leading_rows):
+                                cloud_run_response = self.forward_to_cloud_run()
+                                if "error" not in cloud_run_response:
+                                    fh.terminate()
+                                    return cloud_run_response  # Cloud Run succeeded
+                                logging.warning("Cloud Run processing failed, falling back to normal parsing.")
+                                check_complexity = False
+
+                            # Popping the future drops its records once the sheet is written
+                            if index in futures:
+                                records = futures.pop(index).result()
+                            else:
+                                records = self.build_records(chain(leading_rows, rows))
+                            if not records:
+                                logging.warning(f"Sheet '{sheet_name}' is empty. Skipping.")
+                                continue
+
+                            if sheets_written:
+                                fh.write(b",")
+                            fh.write(orjson.dumps(sheet_name))
+                            fh.write(b":")
+                            fh.write(orjson.dumps(records, default=self.json_serializer, option=orjson.OPT_NAIVE_UTC))
+                            sheets_written += 1
+
+                        except Exception as e:
+                            error_message = f"Error processing sheet '{sheet_name}': {str(e)}"
+                            self.log_error(error_message)
+                            logging.error(error_message)
+                            fh.terminate()
+                            return "Failed to process XLSX file."
+
+                    if not sheets_written:
+                        raise ValueError("No valid data found in the Excel file.")
+                    fh.write(b"}")
+            finally:
+                if pool:
+                    # Running tasks cannot be interrupted; wait for them so no worker outlives the request
+                    pool.shutdown(wait=True, cancel_futures=True)
+                # Read-only workbooks hold the underlying archive open until closed
+                workbook.close()
 
-            # Ensure xlrd==1.2.0 for XLS
-            if file_format == "xls":
-                try:
-                    xls = pd.ExcelFile(BytesIO(excel_data), engine="xlrd")
-                except Exception as e:
-                    raise ValueError(f"Failed to read .xls file. Ensure xlrd==1.2.0 is installed. Error: {str(e)}")
-            else:
-                try:
-                    xls = pd.ExcelFile(BytesIO(excel_data), engine="openpyxl")
-                except Exception as e:
-                    raise ValueError(f"Invalid .xlsx file format: {str(e)}")
-
-            # Forward complex files to Cloud Run
-            if self.detect_complexity(xls):
-                cloud_run_response = self.forward_to_cloud_run()
-                if "error" not in cloud_run_response:
-                    return cloud_run_response  # Cloud Run succeeded
-                logging.warning("Cloud Run processing failed, falling back to normal parsing.")
-
-            # Process simple Excel files
-            data_dict = {}
-            for sheet_name in xls.sheet_names:
-                try:
-                    df = xls.parse(sheet_name, dtype=str, header=0)
-                    df.dropna(axis=1, how="all", inplace=True)
-                    df.dropna(axis=0, how="all", inplace=True)
-
-                    if df.empty:
-                        logging.warning(f"Sheet '{sheet_name}' is empty. Skipping.")
-                        continue
-
-                    data_dict[sheet_name] = df.to_dict(orient="records")
-
-                except Exception as e:
-                    error_message = f"Error processing sheet '{sheet_name}': {str(e)}"
-                    self.log_error(error_message)
-                    logging.error(error_message)
-                    return "Failed to process XLSX file."
-
-            if not data_dict:
-                raise ValueError("No valid data found in the Excel file.")
-
-            json_blob = self.bucket.blob(self.destination_blob)
-            json_blob.upload_from_string(json.dumps(data_dict, indent=4, default=self.json_serializer),
-                                         content_type='application/json')
             logging.info("JSON file successfully created in GCS.")
 
             return "JSON file successfully created in GCS."
@@ -152,6 +376,20 @@ class GCPXLSXParser:
             logging.error(error_message)
             return "Failed to process XLSX file."
 
+def build_sheet_records(excel_data: bytes, file_format: str, sheet_index: int) -> list:
+    """Worker-process entry point: re-opens the workbook and builds the records of a single sheet."""
+    workbook = GCPXLSXParser.open_workbook(BytesIO(excel_data), file_format)
+    try:
+        _, rows = list(GCPXLSXParser.iter_sheets(workbook))[sheet_index]
+        return GCPXLSXParser.build_records(rows)
+    finally:
+        workbook.close()
+
+def output_blob_names(source_blob: str):
+    """Returns the (JSON, error log) blob names for a source blob, replacing its extension."""
+    stem = os.path.splitext(source_blob)[0]
+    return f"{stem}.json", f"{stem}_error.log"
+
 @functions_framework.cloud_event
 def convert_xlsx_to_json(cloud_event):
     """Triggered when an XLS/XLSX file is uploaded to GCS."""
@@ -159,10 +397,10 @@ def convert_xlsx_to_json(cloud_event):
         data = cloud_event.data
         bucket_name = data["bucket"]
         source_blob = data["name"]
-        if not (source_blob.endswith(".xlsx") or source_blob.endswith(".xls")):
+        if not source_blob.endswith((".xlsx", ".xls")):
             logging.warning(f"Ignoring non-Excel file: {source_blob}")
             return "Ignoring non-Excel file."
-        parser = GCPXLSXParser(bucket_name, source_blob, source_blob.replace(".xlsx", ".json").replace(".xls", ".json"), source_blob.replace(".xlsx", "_error.log"))
+        parser = GCPXLSXParser(bucket_name, source_blob, *output_blob_names(source_blob))
         return parser.parse()
     except Exception as e:
         logging.error(f"Critical error in function execution: {str(e)}")
@@ -182,11 +420,7 @@ def convert_xlsx_to_json_http(request):
         if not bucket_name or not source_blob:
             return jsonify({"error": "Missing required parameters"}), 400
 
-        parser = GCPXLSXParser(
-            bucket_name, source_blob,
-            source_blob.replace(".xlsx", ".json").replace(".xls", ".json"),
-            source_blob.replace(".xlsx", "_error.log").replace(".xls", "_error.log")
-        )
+        parser = GCPXLSXParser(bucket_name, source_blob, *output_blob_names(source_blob))
 
         response = parser.parse()
         return jsonify({"message": response})
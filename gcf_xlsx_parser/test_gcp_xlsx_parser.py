@@ -1,13 +1,82 @@
 import unittest
 from unittest.mock import patch, MagicMock
 import pandas as pd
+import orjson
+import requests
 from io import BytesIO
+from datetime import date, datetime
 import os
+import re
+import zipfile
 import logging
-from main import GCPXLSXParser
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+# main builds its GCS client at import time; keep that from needing real credentials
+with patch("google.cloud.storage.Client"):
+    import main
+from main import GCPXLSXParser, output_blob_names
 
 logging.basicConfig(level=logging.DEBUG)
 
+class FakeBlobWriter(BytesIO):
+    """In-memory stand-in for BlobWriter: stores the bytes on close, discards them on terminate()"""
+    def __init__(self, store, name):
+        super().__init__()
+        self.store = store
+        self.name = name
+
+    def terminate(self):
+        super().close()
+
+    def close(self):
+        if not self.closed:
+            self.store[self.name] = self.getvalue()
+        super().close()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.terminate()
+        else:
+            self.close()
+
+class FakeBlob:
+    """In-memory stand-in for a GCS Blob backed by a dict of blob name -> bytes"""
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self.content_type = None
+
+    def _data(self):
+        if self.name not in self.store:
+            raise NotFound(self.name)
+        return self.store[self.name]
+
+    def download_to_file(self, file_obj):
+        file_obj.write(self._data())
+
+    def upload_from_file(self, file_obj, content_type=None, size=None, if_generation_match=None):
+        if if_generation_match == 0 and self.name in self.store:
+            raise PreconditionFailed(self.name)
+        self.store[self.name] = file_obj.read()
+
+    def open(self, mode, chunk_size=None, content_type=None):
+        return FakeBlobWriter(self.store, self.name)
+
+    def compose(self, sources):
+        self.store[self.name] = b"".join(source._data() for source in sources)
+
+    def delete(self):
+        del self.store[self.name]
+
+class FakeBucket:
+    """In-memory stand-in for a GCS Bucket"""
+    def __init__(self, name, files):
+        self.name = name
+        self.store = dict(files)
+
+    def blob(self, name):
+        return FakeBlob(self.store, name)
+
 class TestGCPXLSXParser(unittest.TestCase):
 
     def setUp(self):
@@ -20,6 +89,11 @@ class TestGCPXLSXParser(unittest.TestCase):
         os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "/home/imran_saifmalik/gcf_service_account.json"
         self.parser = GCPXLSXParser(self.bucket_name, self.source_blob, self.destination_blob, self.error_blob)
 
+        # Cloud Run is unreachable unless a test says otherwise, so complex files fall back to local parsing
+        post_patcher = patch.object(main._SESSION, "post", side_effect=requests.exceptions.ConnectionError("unreachable"))
+        post_patcher.start()
+        self.addCleanup(post_patcher.stop)
+
     def create_mock_xlsx(self, data):
         """Create an XLSX file in-memory with correct headers"""
         excel_file = BytesIO()
@@ -28,111 +102,118 @@ class TestGCPXLSXParser(unittest.TestCase):
         excel_file.seek(0)
         return excel_file.getvalue()
 
+    def rewrite_dimension(self, excel_data, ref):
+        """Replace the first sheet's <dimension> record, as some writers leave it stale"""
+        source, output = zipfile.ZipFile(BytesIO(excel_data)), BytesIO()
+        with zipfile.ZipFile(output, "w") as target:
+            for item in source.infolist():
+                content = source.read(item.filename)
+                if item.filename == "xl/worksheets/sheet1.xml":
+                    content = re.sub(rb'<dimension ref="[^"]*"/>', f'<dimension ref="{ref}"/>'.encode(), content)
+                target.writestr(item, content)
+        return output.getvalue()
+
+    def use_fake_bucket(self, excel_data):
+        """Point the parser at an in-memory bucket holding the source workbook"""
+        self.parser.bucket = FakeBucket(self.bucket_name, {self.source_blob: excel_data})
+        return self.parser.bucket
+
+    def uploaded_json(self):
+        """Decode the JSON document the parser uploaded"""
+        return orjson.loads(self.parser.bucket.store[self.destination_blob])
+
     def debug_check_headers(self, df):
         """Verify headers before returning DataFrame"""
         logging.debug(f"Mock XLSX headers: {df.columns.tolist()}")
         return df
 
-    @patch("google.cloud.storage.Client")
-    def test_xlsx_correct_headers(self, mock_storage_client):
+    def test_xlsx_correct_headers(self):
         """Test with correct headers to ensure validation passes"""
         df = pd.DataFrame({"Title": ["Doc1"], "Date": ["2025-02-10"]})
         df = self.debug_check_headers(df)
 
-        mock_blob = MagicMock()
-        mock_blob.download_as_bytes.return_value = self.create_mock_xlsx(df)
-        mock_storage_client().bucket().blob.return_value = mock_blob
+        self.use_fake_bucket(self.create_mock_xlsx(df))
 
         result = self.parser.parse()
         self.assertEqual(result, "JSON file successfully created in GCS.")
+        self.assertEqual(self.uploaded_json(), {"Sheet1": [{"Title": "Doc1", "Date": "2025-02-10"}]})
 
-    @patch("google.cloud.storage.Client")
-    def test_xlsx_missing_headers(self, mock_storage_client):
+    def test_xlsx_missing_headers(self):
         """Test handling of an XLSX file where expected headers are missing."""
         
         # Creating a DataFrame with completely different column names
         data = pd.DataFrame({"RandomColumn1": ["Data1"], "RandomColumn2": ["Data2"]})
 
-        mock_blob = MagicMock()
-        mock_blob.download_as_bytes.return_value = self.create_mock_xlsx(data)
-        mock_storage_client().bucket().blob.return_value = mock_blob
+        self.use_fake_bucket(self.create_mock_xlsx(data))
 
         result = self.parser.parse()
 
         # Since we removed strict header validation, expect SUCCESS
         self.assertEqual(result, "JSON file successfully created in GCS.")
+        self.assertEqual(self.uploaded_json(), {"Sheet1": [{"RandomColumn1": "Data1", "RandomColumn2": "Data2"}]})
 
 
 
 
-    @patch("google.cloud.storage.Client")
-    def test_xlsx_extra_columns(self, mock_storage_client):
+    def test_xlsx_extra_columns(self):
         """Test success when required headers exist, even if extra columns are present"""
         df = pd.DataFrame({"Title": ["Doc1"], "Date": ["2025-02-10"], "ExtraColumn": ["ExtraValue"]})
         df = self.debug_check_headers(df)
 
-        mock_blob = MagicMock()
-        mock_blob.download_as_bytes.return_value = self.create_mock_xlsx(df)
-        mock_storage_client().bucket().blob.return_value = mock_blob
+        self.use_fake_bucket(self.create_mock_xlsx(df))
 
         result = self.parser.parse()
         self.assertEqual(result, "JSON file successfully created in GCS.")
+        self.assertEqual(self.uploaded_json(), {"Sheet1": [{"Title": "Doc1", "Date": "2025-02-10", "ExtraColumn": "ExtraValue"}]})
 
-    @patch("google.cloud.storage.Client")
-    def test_xlsx_special_characters(self, mock_storage_client):
+    def test_xlsx_special_characters(self):
         """Test handling of an XLSX file with special characters"""
         df = pd.DataFrame({"Title": ["Hello 😊"], "Date": ["2025-02-10"]})
         df = self.debug_check_headers(df)
 
-        mock_blob = MagicMock()
-        mock_blob.download_as_bytes.return_value = self.create_mock_xlsx(df)
-        mock_storage_client().bucket().blob.return_value = mock_blob
+        self.use_fake_bucket(self.create_mock_xlsx(df))
 
         result = self.parser.parse()
         self.assertEqual(result, "JSON file successfully created in GCS.")
+        self.assertEqual(self.uploaded_json(), {"Sheet1": [{"Title": "Hello 😊", "Date": "2025-02-10"}]})
 
-    @patch("google.cloud.storage.Client")
-    def test_xlsx_empty_rows(self, mock_storage_client):
+    def test_xlsx_empty_rows(self):
         """Test handling of an XLSX file with empty rows"""
         df = pd.DataFrame({"Title": ["Doc1", None], "Date": ["2025-02-10", None]})
         df = self.debug_check_headers(df)
 
-        mock_blob = MagicMock()
-        mock_blob.download_as_bytes.return_value = self.create_mock_xlsx(df)
-        mock_storage_client().bucket().blob.return_value = mock_blob
+        self.use_fake_bucket(self.create_mock_xlsx(df))
 
         result = self.parser.parse()
         self.assertEqual(result, "JSON file successfully created in GCS.")
+        self.assertEqual(self.uploaded_json(), {"Sheet1": [{"Title": "Doc1", "Date": "2025-02-10"}]})
 
-    @patch("google.cloud.storage.Client")
-    def test_xlsx_different_date_formats(self, mock_storage_client):
+    def test_xlsx_different_date_formats(self):
         """Test handling of an XLSX file with different date formats"""
         df = pd.DataFrame({"Title": ["Doc1"], "Date": ["10-Feb-2025"]})
         df["Date"] = pd.to_datetime(df["Date"], errors="coerce").dt.strftime("%Y-%m-%d")
         df = self.debug_check_headers(df)
 
-        mock_blob = MagicMock()
-        mock_blob.download_as_bytes.return_value = self.create_mock_xlsx(df)
-        mock_storage_client().bucket().blob.return_value = mock_blob
+        self.use_fake_bucket(self.create_mock_xlsx(df))
 
         result = self.parser.parse()
         self.assertEqual(result, "JSON file successfully created in GCS.")
+        self.assertEqual(self.uploaded_json(), {"Sheet1": [{"Title": "Doc1", "Date": "2025-02-10"}]})
 
-    @patch("google.cloud.storage.Client")
-    def test_xlsx_large_dataset(self, mock_storage_client):
+    def test_xlsx_large_dataset(self):
         """Test handling of an XLSX file with a large dataset"""
         df = pd.DataFrame({"Title": ["Doc"] * 100000, "Date": ["2025-02-10"] * 100000})
         df = self.debug_check_headers(df)
 
-        mock_blob = MagicMock()
-        mock_blob.download_as_bytes.return_value = self.create_mock_xlsx(df)
-        mock_storage_client().bucket().blob.return_value = mock_blob
+        self.use_fake_bucket(self.create_mock_xlsx(df))
 
         result = self.parser.parse()
         self.assertEqual(result, "JSON file successfully created in GCS.")
+        sheet = self.uploaded_json()["Sheet1"]
+        self.assertEqual(len(sheet), 100000)
+        self.assertEqual(sheet[-1], {"Title": "Doc", "Date": "2025-02-10"})
 
-    @patch("google.cloud.storage.Client")
-    def test_xlsx_merged_cells(self, mock_storage_client):
+    def test_xlsx_merged_cells(self):
         """Test handling of an XLSX file with merged cells"""
         df = pd.DataFrame({"Title": ["Doc1"], "Date": ["2025-02-10"]})
         df = self.debug_check_headers(df)
@@ -142,12 +223,238 @@ class TestGCPXLSXParser(unittest.TestCase):
             df.to_excel(writer, index=False, merge_cells=True)
         excel_file.seek(0)
 
-        mock_blob = MagicMock()
-        mock_blob.download_as_bytes.return_value = excel_file.getvalue()
-        mock_storage_client().bucket().blob.return_value = mock_blob
+        self.use_fake_bucket(excel_file.getvalue())
 
         result = self.parser.parse()
         self.assertEqual(result, "JSON file successfully created in GCS.")
+        self.assertEqual(self.uploaded_json(), {"Sheet1": [{"Title": "Doc1", "Date": "2025-02-10"}]})
+
+    def test_xlsx_stale_dimension_record(self):
+        """Test that rows and columns outside a stale <dimension> record are still parsed"""
+        df = pd.DataFrame({"A": range(5), "B": range(0, 10, 2), "C": range(0, 15, 3)})
+        self.use_fake_bucket(self.rewrite_dimension(self.create_mock_xlsx(df), "A1:B3"))
+
+        result = self.parser.parse()
+
+        self.assertEqual(result, "JSON file successfully created in GCS.")
+        self.assertEqual(self.uploaded_json(), {"Sheet1": [{"A": i, "B": 2 * i, "C": 3 * i} for i in range(5)]})
+
+    def test_xlsx_single_cell_dimension_record(self):
+        """Test that a data sheet whose <dimension> claims a single cell is parsed rather than skipped as empty"""
+        df = pd.DataFrame({"Title": ["Doc1", "Doc2"], "Date": ["2025-02-10", "2025-02-11"]})
+        self.use_fake_bucket(self.rewrite_dimension(self.create_mock_xlsx(df), "A1"))
+
+        result = self.parser.parse()
+
+        self.assertEqual(result, "JSON file successfully created in GCS.")
+        self.assertEqual(self.uploaded_json(), {"Sheet1": [
+            {"Title": "Doc1", "Date": "2025-02-10"},
+            {"Title": "Doc2", "Date": "2025-02-11"},
+        ]})
+
+    def test_complex_file_forwarded_to_cloud_run(self):
+        """Test that a sheet with gaps in its leading rows is sent to Cloud Run and no JSON is written locally"""
+        df = pd.DataFrame({"Title": ["Doc1", "Doc2"], "Date": ["2025-02-10", None]})
+        bucket = self.use_fake_bucket(self.create_mock_xlsx(df))
+
+        with patch.object(main._SESSION, "post") as mock_post:
+            mock_post.return_value.status_code = 200
+            mock_post.return_value.json.return_value = {"message": "parsed by Cloud Run"}
+            result = self.parser.parse()
+
+        self.assertEqual(result, {"message": "parsed by Cloud Run"})
+        self.assertNotIn(self.destination_blob, bucket.store)
+
+    def test_complex_file_falls_back_when_cloud_run_fails(self):
+        """Test that rows read for complexity detection are still part of the locally parsed output"""
+        df = pd.DataFrame({"Title": ["Doc1", "Doc2"], "Date": ["2025-02-10", None]})
+        self.use_fake_bucket(self.create_mock_xlsx(df))
+
+        result = self.parser.parse()
+
+        self.assertEqual(result, "JSON file successfully created in GCS.")
+        self.assertEqual(self.uploaded_json(), {"Sheet1": [
+            {"Title": "Doc1", "Date": "2025-02-10"},
+            {"Title": "Doc2", "Date": None},
+        ]})
+
+    def test_xlsx_multiple_sheets(self):
+        """Test that every non-empty sheet is written in workbook order and empty sheets are skipped"""
+        excel_file = BytesIO()
+        with pd.ExcelWriter(excel_file, engine="xlsxwriter") as writer:
+            pd.DataFrame({"a": [1, 2]}).to_excel(writer, sheet_name="First", index=False)
+            pd.DataFrame().to_excel(writer, sheet_name="Empty", index=False)
+            pd.DataFrame({"b": ["x"]}).to_excel(writer, sheet_name="Second", index=False)
+        self.use_fake_bucket(excel_file.getvalue())
+
+        result = self.parser.parse()
+
+        self.assertEqual(result, "JSON file successfully created in GCS.")
+        self.assertEqual(list(self.uploaded_json().items()), [
+            ("First", [{"a": 1}, {"a": 2}]),
+            ("Second", [{"b": "x"}]),
+        ])
+
+    def create_multi_sheet_xlsx(self, sheets):
+        excel_file = BytesIO()
+        with pd.ExcelWriter(excel_file, engine="xlsxwriter") as writer:
+            for sheet_name, df in sheets.items():
+                df.to_excel(writer, sheet_name=sheet_name, index=False)
+        return excel_file.getvalue()
+
+    @patch("main.os.cpu_count", return_value=2)
+    @patch("main.PARALLEL_PARSE_MIN_BYTES", 1)
+    def test_xlsx_multiple_sheets_parsed_in_parallel(self, _):
+        """Test that sheets parsed by worker processes are written exactly as a sequential parse would"""
+        first = pd.DataFrame({"id": range(200), "name": [f"row{i}" for i in range(200)]})
+        self.use_fake_bucket(self.create_multi_sheet_xlsx({
+            "First": first, "Short": pd.DataFrame({"b": ["x"]}), "Second": first.head(120),
+        }))
+
+        result = self.parser.parse()
+
+        self.assertEqual(result, "JSON file successfully created in GCS.")
+        self.assertEqual(list(self.uploaded_json().items()), [
+            ("First", first.to_dict(orient="records")),
+            ("Short", [{"b": "x"}]),
+            ("Second", first.head(120).to_dict(orient="records")),
+        ])
+
+    @patch("main.os.cpu_count", return_value=2)
+    @patch("main.PARALLEL_PARSE_MIN_BYTES", 1)
+    def test_complex_multi_sheet_file_forwarded_before_parsing(self, _):
+        """Test that a complex sheet anywhere in a large workbook is forwarded before any worker is started"""
+        simple = pd.DataFrame({"id": range(200)})
+        complex_df = pd.DataFrame({"Title": ["Doc1", "Doc2"], "Date": ["2025-02-10", None]})
+        bucket = self.use_fake_bucket(self.create_multi_sheet_xlsx({"Simple": simple, "Complex": complex_df}))
+
+        with patch.object(main._SESSION, "post") as mock_post, patch("main.ProcessPoolExecutor") as mock_pool:
+            mock_post.return_value.status_code = 200
+            mock_post.return_value.json.return_value = {"message": "parsed by Cloud Run"}
+            result = self.parser.parse()
+
+        self.assertEqual(result, {"message": "parsed by Cloud Run"})
+        mock_pool.assert_not_called()
+        self.assertNotIn(self.destination_blob, bucket.store)
+
+    def test_missing_source_file(self):
+        """Test that a missing source blob is reported in the error log"""
+        bucket = self.use_fake_bucket(b"")
+        del bucket.store[self.source_blob]
+
+        result = self.parser.parse()
+
+        self.assertEqual(result, "Failed to process XLSX file.")
+        self.assertIn(b"does not exist in bucket", bucket.store[self.error_blob])
+        self.assertNotIn(self.destination_blob, bucket.store)
+
+    def test_log_error_creates_log_in_one_request(self):
+        """Test that the first error creates the log with a create-only upload and nothing else"""
+        self.parser.bucket = MagicMock()
+        error_blob = self.parser.bucket.blob.return_value
+
+        self.parser.log_error("Something failed")
+
+        self.parser.bucket.blob.assert_called_once_with(self.error_blob)
+        error_blob.upload_from_file.assert_called_once()
+        uploaded, = error_blob.upload_from_file.call_args.args
+        self.assertEqual(uploaded.getvalue(), b"Something failed\n")
+        self.assertEqual(error_blob.upload_from_file.call_args.kwargs["if_generation_match"], 0)
+        error_blob.compose.assert_not_called()
+        error_blob.exists.assert_not_called()
+
+    def test_log_error_appends_via_compose(self):
+        """Test that an existing error log is appended to with compose rather than re-uploaded"""
+        self.parser.bucket = FakeBucket(self.bucket_name, {self.error_blob: b"First failure\n"})
+
+        self.parser.log_error("Something failed")
+
+        self.assertEqual(self.parser.bucket.store, {self.error_blob: b"First failure\nSomething failed\n"})
+
+    @patch.object(main._SESSION, "post")
+    def test_forward_to_cloud_run_uses_shared_session(self, mock_post):
+        """Test that the Cloud Run forward goes through the pooled session with a JSON body"""
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json.return_value = {"message": "ok"}
+        self.parser.bucket = MagicMock()
+        self.parser.bucket.name = self.bucket_name
+
+        result = self.parser.forward_to_cloud_run()
+
+        self.assertEqual(result, {"message": "ok"})
+        _, kwargs = mock_post.call_args
+        self.assertEqual(kwargs["headers"], {"Content-Type": "application/json"})
+        self.assertEqual(kwargs["data"], b'{"bucket_name":"xlsx-test-bucket","file_name":"test.xlsx"}')
+
+    def test_cloud_run_retries_skip_possibly_processed_requests(self):
+        """Test that the POST is not retried after a read error or a gateway timeout"""
+        retry = main._SESSION.get_adapter("https://cloud-run.example").max_retries
+
+        self.assertEqual(retry.read, 0)
+        self.assertGreater(retry.connect, 0)
+        self.assertEqual(set(retry.status_forcelist), {502, 503})
+
+    def test_build_records_drops_empty_rows_and_columns(self):
+        """Test that records skip empty rows and columns and keep header names as keys"""
+        rows = [
+            ("Title", "Empty", None, "Count"),
+            ("Doc1", None, None, 1),
+            (None, None, None, None),
+            ("Doc2", None, "x", None),
+        ]
+
+        records = GCPXLSXParser.build_records(rows)
+
+        self.assertEqual(records, [
+            {"Title": "Doc1", "Unnamed: 2": None, "Count": 1},
+            {"Title": "Doc2", "Unnamed: 2": "x", "Count": None},
+        ])
+
+        # Ragged rows, as read-only openpyxl yields after reset_dimensions()
+        records = GCPXLSXParser.build_records([("Title",), ("Doc1", 5), (), ("Doc2",)])
+        self.assertEqual(records, [{"Title": "Doc1", "Unnamed: 1": 5}, {"Title": "Doc2", "Unnamed: 1": None}])
+
+        # Repeated header names are suffixed rather than collapsed into one key
+        records = GCPXLSXParser.build_records([("A", "A", "B", "A.1"), (1, 2, 3, 4)])
+        self.assertEqual(records, [{"A": 1, "A.2": 2, "B": 3, "A.1": 4}])
+        records = GCPXLSXParser.build_records([("A", "A", "B", "A"), (1, 2, 3, 4)])
+        self.assertEqual(records, [{"A": 1, "A.1": 2, "B": 3, "A.2": 4}])
+
+    def test_calamine_rows_restore_integers(self):
+        """Test that whole-number floats from calamine become ints and empty cells become None"""
+        workbook = MagicMock()
+        workbook.get_sheet_by_name.return_value.iter_rows.return_value = iter([
+            ["Count", "Price", "Flag", "Note"],
+            [3.0, 2.5, True, ""],
+        ])
+
+        rows = list(GCPXLSXParser.iter_calamine_rows(workbook, "Sheet1"))
+
+        self.assertEqual(rows, [("Count", "Price", "Flag", "Note"), (3, 2.5, True, None)])
+        self.assertIs(type(rows[1][0]), int)
+        self.assertIs(rows[1][2], True)
+
+    def test_calamine_rows_keep_large_floats_and_widen_dates(self):
+        """Test that out-of-range whole numbers stay floats and date-only cells become midnight datetimes"""
+        workbook = MagicMock()
+        workbook.get_sheet_by_name.return_value.iter_rows.return_value = iter([
+            ["Big", "Max", "Date", "Stamp"],
+            [1e20, 2.0**64, date(2025, 2, 10), datetime(2025, 2, 10, 9, 30)],
+        ])
+
+        rows = list(GCPXLSXParser.iter_calamine_rows(workbook, "Sheet1"))
+
+        self.assertEqual(rows[1], (1e20, 2.0**64, datetime(2025, 2, 10), datetime(2025, 2, 10, 9, 30)))
+        self.assertIs(type(rows[1][0]), float)
+        self.assertIs(type(rows[1][1]), float)
+        self.assertEqual(orjson.dumps(rows[1], option=orjson.OPT_NAIVE_UTC),
+                         b'[1e20,1.8446744073709552e19,"2025-02-10T00:00:00+00:00","2025-02-10T09:30:00+00:00"]')
+
+    def test_output_blob_names(self):
+        """Test that output names replace only the trailing Excel extension"""
+        self.assertEqual(output_blob_names("reports/q1.xlsx"), ("reports/q1.json", "reports/q1_error.log"))
+        self.assertEqual(output_blob_names("legacy.xls"), ("legacy.json", "legacy_error.log"))
+        self.assertEqual(output_blob_names("a.xlsx.bak/data.xls"), ("a.xlsx.bak/data.json", "a.xlsx.bak/data_error.log"))
 
 if __name__ == "__main__":
     unittest.main()